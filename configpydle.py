@@ -23,32 +23,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-from datetime import datetime, timezone
-
 import asyncio
-import configparser
 import pydle
+import time
 
 
 
-_boolean_false_values = [
-	'false',
-	'no',
-]
-
-_boolean_true_values = [
-	'true',
-	'yes',
-]
-
-_connect_whitelist = [
+_connect_whitelist = frozenset({
 	'hostname',
 	'password',
 	'port',
 	'tls',
-]
+})
 
-_ctor_whitelist = [
+_ctor_whitelist = frozenset({
 	'nickname',
 	'realname',
 	'sasl_identity',
@@ -59,7 +47,7 @@ _ctor_whitelist = [
 	'tls_client_cert_key',
 	'tls_client_cert_password',
 	'username',
-]
+})
 
 _default_config_keys = {
 	'connect_timeout':  '10',
@@ -69,83 +57,200 @@ _default_config_keys = {
 	'tls_verify':       'True',
 }
 
-_required_config_keys = [
+_scalar_values = {
+	'false':            False,
+	'no':               False,
+	'none':             None,
+	'true':             True,
+	'yes':              True,
+}
+
+_required_config_keys = frozenset({
 	'hostname',
 	'nickname',
 	'realname',
 	'username',
-]
+})
 
-_var_int_max = {
-	'connect_timeout':  30,
-	'port':             65535,
+_var_int_ranges = {
+	'connect_timeout':  range(1, 31),
+	'port':             range(1, 65536),
 }
 
 
 
+def _interpolate(config, key, depth=0):
+
+	# A cut-down ExtendedInterpolation: ${key} and ${config:key} are replaced by the (recursively
+	# interpolated) value of that key, and $$ is an escaped $
+	if depth > 10:
+		raise ValueError(f'Interpolation of the {key} variable is nested too deeply')
+
+	# Defaults given by the caller may not be strings; configparser would have str()'d them as well
+	val = str(config[key])
+	parts = []
+
+	while '$' in val:
+		pos = val.index('$')
+		parts.append(val[:pos])
+		val = val[pos:]
+
+		if val.startswith('$$'):
+			parts.append('$')
+			val = val[2:]
+		elif val.startswith('${') and '}' in val:
+			end = val.index('}')
+			ref = val[2:end]
+			if ref.startswith('config:'):
+				ref = ref[7:]
+			ref = ref.lower()
+			if ref not in config:
+				raise KeyError(f'The {key} variable refers to {ref}, which does not exist')
+			parts.append(_interpolate(config, ref, depth + 1))
+			val = val[end + 1:]
+		else:
+			raise ValueError(f'The {key} variable contains a bad interpolation: {val}')
+
+	parts.append(val)
+	return ''.join(parts)
+
+
+
+def _read_ini(path):
+
+	# Only the [config] section (and any keys before the first section header) is of interest to us,
+	# so a full configparser is unnecessary
+	config = {}
+	section = 'config'
+	key = None
+	key_indent = 0
+
+	with open(path) as f:
+		for lineno, line in enumerate(f, 1):
+			stripped = line.strip()
+			if not stripped or stripped[0] in '#;':
+				continue
+
+			# Lines indented further than the previous key continue its value
+			indent = len(line) - len(line.lstrip())
+			if key is not None and indent > key_indent:
+				if section == 'config':
+					config[key] = f'{config[key]}\n{stripped}'
+				continue
+
+			if stripped[0] == '[' and stripped[-1] == ']':
+				section = stripped[1:-1].strip()
+				key = None
+				continue
+
+			pos = min((stripped.find(delim) for delim in '=:' if delim in stripped), default=-1)
+			if pos < 1:
+				raise ValueError(f'{path}:{lineno}: Expected a key = value line, got: {stripped}')
+
+			key = stripped[:pos].strip().lower()
+			key_indent = indent
+			if section == 'config':
+				config[key] = stripped[pos + 1:].strip()
+
+	return config
+
+
+
+def _coerce_auto(raw):
+
+	# Booleans and None
+	lowered = raw.lower()
+	if lowered in _scalar_values:
+		return _scalar_values[lowered]
+
+	# Integers
+	try:
+		return int(raw)
+	except ValueError:
+		return raw
+
+
+
+def _coerce_int(raw):
+
+	# Invalid values are left alone, to be rejected with a proper error message by the validation
+	try:
+		return int(raw)
+	except ValueError:
+		return raw
+
+
+
+# The types of these keys are known in advance, so there's no need to guess at them. The boolean keys
+# (tls, tls_verify) still go through _coerce_auto(), as e.g. tls = 0 must remain falsy
+_key_coercers = {
+	'connect_timeout':  _coerce_int,
+	'port':             _coerce_int,
+}
+
+
+
+def _parse_config(path, default_config_keys, loader):
+
+	config = {**default_config_keys, **loader(path)}
+
+	# ${key} references are INI syntax, and may also refer to the defaults
+	if loader is _read_ini:
+		config = {key: _interpolate(config, key) if isinstance(val, str) else val
+		          for key, val in config.items()}
+
+	# Loaders for typed formats (e.g. YAML) may return values that need no coercion
+	return {key: _key_coercers.get(key, _coerce_auto)(val) if isinstance(val, str) else val
+	        for key, val in config.items()}
+
+
+
 class Client(pydle.Client):
 
-	def __init__(self, path=None, eventloop=None, default_config_keys={}, required_config_keys=[]):
+	def __init__(self, path=None, eventloop=None, default_config_keys=None, required_config_keys=None,
+	             loader=_read_ini):
 
 		self.autoperform_done = False
 		self.phcfg = {}
+		self._ready = None
+		self._channel_events = {}
 
 		if path is None:
 			raise ValueError('The path to the configuration file must be given')
 
-		for key in _default_config_keys:
-			if key not in default_config_keys:
-				default_config_keys[key] = _default_config_keys[key]
-
-		for key in _required_config_keys:
-			if key not in required_config_keys:
-				required_config_keys.append(key)
-
-		with open(path) as f:
-			_parser = configparser.ConfigParser(defaults=default_config_keys, default_section='config',
-			                                    interpolation=configparser.ExtendedInterpolation())
-			_parser.read_file(f)
-			for key in _parser['config']:
-				self.phcfg[key] = _parser['config'][key]
-
-				# Integers
-				try:
-					if not isinstance(self.phcfg[key], bool):
-						val = int(self.phcfg[key])
-						self.phcfg[key] = val
-				except (TypeError, ValueError):
-					pass
-
-				# Booleans
-				if str(self.phcfg[key]).lower() in _boolean_false_values:
-					self.phcfg[key] = False
-				if str(self.phcfg[key]).lower() in _boolean_true_values:
-					self.phcfg[key] = True
-
-				# None
-				if str(self.phcfg[key]).lower() == 'none':
-					self.phcfg[key] = None
-
-		for key in required_config_keys:
-			if key not in self.phcfg:
-				raise KeyError(f'Required key {key} in config file is missing')
-
-		for var in _var_int_max.keys():
-			if not isinstance(self.phcfg[var], int):
-				raise ValueError(f'The {var} variable must be an integer')
-			if self.phcfg[var] < 1:
-				raise ValueError(f'The {var} variable must be greater than or equal to 1')
-			if self.phcfg[var] > _var_int_max[var]:
-				raise ValueError(f'The {var} variable must be less than or equal to ' \
-				                 f'{_var_int_max[var]}')
-
-		# This is because super().__init__() doesn't silently ignore keys it doesn't use...
-		_kwargs = {}
-		for key in _ctor_whitelist:
-			if key in self.phcfg:
-				_kwargs[key] = self.phcfg[key]
-
-		super().__init__(eventloop=eventloop, **_kwargs)
+		default_config_keys = {**_default_config_keys, **(default_config_keys or {})}
+		required_config_keys = _required_config_keys.union(required_config_keys or ())
+
+		# The loader is called with the path, and must return a dictionary mapping each key to its value;
+		# the default keys are merged in, and string values are then coerced as usual
+		self.phcfg = _parse_config(path, default_config_keys, loader)
+
+		missing = required_config_keys - self.phcfg.keys()
+		if missing:
+			raise KeyError(f'Required key(s) {", ".join(sorted(missing))} in config file are missing')
+
+		for var, valid in _var_int_ranges.items():
+			val = self.phcfg.get(var)
+			if not (isinstance(val, int) and val in valid):
+				raise ValueError(f'The {var} variable must be an integer between {valid.start} and ' \
+				                 f'{valid.stop - 1}')
+
+		self._refresh_kwargs()
+
+		super().__init__(eventloop=eventloop, **self._ctor_kwargs)
+
+		# Resolved once here rather than on every line sent by message() and notice()
+		self._raw_message = super().message
+		self._raw_notice = super().notice
+
+
+
+	def _refresh_kwargs(self):
+
+		# This is because super().__init__() and super().connect() don't silently ignore keys they don't
+		# use... Call this again if self.phcfg is changed after construction
+		self._connect_kwargs = {key: self.phcfg[key] for key in _connect_whitelist if key in self.phcfg}
+		self._ctor_kwargs = {key: self.phcfg[key] for key in _ctor_whitelist if key in self.phcfg}
 
 
 
@@ -161,17 +266,16 @@ class Client(pydle.Client):
 
 	async def connect(self, reconnect=False):
 
-		# This is because super().connect() doesn't silently ignore keys it doesn't use...
-		_kwargs = {}
-		for key in _connect_whitelist:
-			if key in self.phcfg:
-				_kwargs[key] = self.phcfg[key]
+		# Created here rather than in __init__(), so that it is bound to the loop we are running on
+		# (which on Python < 3.10 need not be the one asyncio.get_event_loop() returned back then)
+		if self._ready is None:
+			self._ready = asyncio.Event()
 
-		_rem = 20 * self.phcfg['connect_timeout']
-		await super().connect(reconnect=reconnect, **_kwargs)
-		while _rem and not self.connected:
-			await asyncio.sleep(0.05)
-			_rem -= 1
+		await super().connect(reconnect=reconnect, **self._connect_kwargs)
+		try:
+			await asyncio.wait_for(self._ready.wait(), self.phcfg['connect_timeout'])
+		except asyncio.TimeoutError:
+			pass
 
 
 
@@ -197,14 +301,91 @@ class Client(pydle.Client):
 			await self.away(self.phcfg['away_message'])
 
 		self.autoperform_done = True
+		if self._ready is not None:
+			self._ready.set()
 
 
 
 	async def on_disconnect(self, expected):
 
+		# This must happen before super().on_disconnect(), as that is where pydle reconnects
+		self.autoperform_done = False
+		if self._ready is not None:
+			self._ready.clear()
+		for event in self._channel_events.values():
+			event.set()
+		self._channel_events.clear()
+
 		await super().on_disconnect(expected)
 
-		self.autoperform_done = False
+
+
+	async def on_join(self, channel, user):
+
+		await super().on_join(channel, user)
+
+		if self.is_same_nick(self.nickname, user):
+			self._channel_events.setdefault(self.normalize(channel), asyncio.Event()).set()
+
+
+
+	async def on_kick(self, channel, target, by, reason=None):
+
+		await super().on_kick(channel, target, by, reason)
+
+		if self.is_same_nick(self.nickname, target):
+			self._forget_channel(channel)
+
+
+
+	async def on_part(self, channel, user, message=None):
+
+		await super().on_part(channel, user, message)
+
+		if self.is_same_nick(self.nickname, user):
+			self._forget_channel(channel)
+
+
+
+	def _forget_channel(self, channel):
+
+		# Anything still waiting in _join_channel() is woken up; the next message will try to join again
+		event = self._channel_events.pop(self.normalize(channel), None)
+		if event is not None:
+			event.set()
+
+
+
+	async def _join_failed(self, message, quiet=False):
+
+		if len(message.params) > 1:
+			self._forget_channel(message.params[1])
+
+		# These would otherwise have been logged by pydle as unknown numerics, which is how an operator
+		# finds out why we aren't in a channel
+		if not quiet:
+			await self.on_unknown(message)
+
+
+
+	async def _join_channel(self, channel):
+
+		# Only one JOIN is sent per channel; anything else wanting to talk there waits for it to complete
+		key = self.normalize(channel)
+		event = self._channel_events.get(key)
+		if event is None:
+			event = self._channel_events[key] = asyncio.Event()
+			try:
+				await self.join(channel)
+			except:
+				pass
+
+		try:
+			await asyncio.wait_for(event.wait(), self.phcfg['connect_timeout'])
+		except asyncio.TimeoutError:
+			# The JOIN went unanswered; allow a later message to try again
+			if self._channel_events.get(key) is event:
+				del self._channel_events[key]
 
 
 
@@ -214,12 +395,11 @@ class Client(pydle.Client):
 			return
 
 		if self.is_channel(target) and not self.in_channel(target):
-			try:
-				await self.join(target)
-			except:
-				pass
+			await self._join_channel(target)
+			if not self.connected:
+				return
 
-		await super().message(target, message)
+		await self._raw_message(target, message)
 
 
 
@@ -229,12 +409,11 @@ class Client(pydle.Client):
 			return
 
 		if self.is_channel(target) and not self.in_channel(target):
-			try:
-				await self.join(target)
-			except:
-				pass
+			await self._join_channel(target)
+			if not self.connected:
+				return
 
-		await super().notice(target, message)
+		await self._raw_notice(target, message)
 
 
 
@@ -242,7 +421,7 @@ class Client(pydle.Client):
 		await self.ctcp_reply(source, 'PING', contents)
 
 	async def on_ctcp_time(self, source, target, contents):
-		await self.ctcp_reply(source, 'TIME', datetime.now(tz=timezone.utc).isoformat(timespec='seconds'))
+		await self.ctcp_reply(source, 'TIME', time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()))
 
 	async def on_raw_306(self, message):
 		pass
@@ -253,8 +432,34 @@ class Client(pydle.Client):
 	async def on_raw_458(self, message):
 		pass
 
+	# The JOIN numerics below are all failures (or a forward elsewhere) for the channel in params[1]
+
+	async def on_raw_403(self, message):
+		await self._join_failed(message)
+
+	async def on_raw_405(self, message):
+		await self._join_failed(message)
+
 	async def on_raw_470(self, message):
-		pass
+		await self._join_failed(message, quiet=True)
+
+	async def on_raw_471(self, message):
+		await self._join_failed(message)
 
 	async def on_raw_473(self, message):
-		pass
+		await self._join_failed(message, quiet=True)
+
+	async def on_raw_474(self, message):
+		await self._join_failed(message)
+
+	async def on_raw_475(self, message):
+		await self._join_failed(message)
+
+	async def on_raw_476(self, message):
+		await self._join_failed(message)
+
+	async def on_raw_477(self, message):
+		await self._join_failed(message)
+
+	async def on_raw_480(self, message):
+		await self._join_failed(message)